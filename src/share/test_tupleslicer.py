@@ -0,0 +1,253 @@
+## Tests for tupleslicer.py.  Run from the top of the tree with:
+##
+##   python3 -m unittest discover -s src/share
+##
+## The module itself imports Ryu, so the tests are skipped where it is
+## not installed.
+
+import random
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+try:
+    import tupleslicer
+    from ryu.lib import hub
+    from ryu.lib import dpid as dpid_lib
+    from ryu.ofproto import ofproto_v1_3, ofproto_v1_3_parser
+except ImportError as e:
+    raise unittest.SkipTest(f'tupleslicer cannot be imported: {e}')
+
+## Get the set of ids below limit selected by any (cookie,
+## cookie_mask) pair.
+def covered(blocks, limit):
+    return { i for i in range(limit)
+             if any(i & mask == cookie for (cookie, mask) in blocks) }
+
+class CookieBlocksTest(unittest.TestCase):
+    def assertCovers(self, ids, limit=256):
+        blocks = tupleslicer.cookie_blocks(ids)
+        self.assertEqual(covered(blocks, limit), set(ids))
+        return blocks
+
+    def test_empty(self):
+        self.assertEqual(tupleslicer.cookie_blocks([]), [])
+
+    def test_single(self):
+        blocks = self.assertCovers([5])
+        self.assertEqual(blocks, [(5, tupleslicer._COOKIE_MASK)])
+
+    def test_aligned_run(self):
+        blocks = self.assertCovers(range(8, 16))
+        self.assertEqual(blocks, [(8, tupleslicer._COOKIE_MASK ^ 7)])
+
+    def test_from_zero(self):
+        blocks = self.assertCovers(range(0, 4))
+        self.assertEqual(blocks, [(0, tupleslicer._COOKIE_MASK ^ 3)])
+
+    def test_gaps(self):
+        blocks = self.assertCovers([1, 3, 5, 9])
+        self.assertEqual(len(blocks), 4)
+
+    def test_unaligned_run(self):
+        blocks = self.assertCovers(range(3, 11))
+        self.assertEqual([ c for (c, _) in blocks ], [3, 4, 8, 10])
+
+    def test_unsorted(self):
+        self.assertCovers([7, 2, 6, 3, 0])
+
+    def test_random(self):
+        rng = random.Random(1)
+        for _ in range(500):
+            ids = rng.sample(range(64), rng.randint(0, 64))
+            self.assertCovers(ids, limit=128)
+
+## Two tuples conflict if one is a prefix of the other.
+def prefix_conflict(tup1, tup2):
+    n = min(len(tup1), len(tup2))
+    return tup1[:n] == tup2[:n]
+
+class TupleConflictTest(unittest.TestCase):
+    def test_examples(self):
+        self.assertTrue(tupleslicer.tuples_conflict((6,), (6, 100)))
+        self.assertTrue(tupleslicer.tuples_conflict((6, 100),
+                                                    (6, 100, 200)))
+        self.assertTrue(tupleslicer.tuples_conflict((6, 100), (6, 100)))
+        self.assertFalse(tupleslicer.tuples_conflict((6, 100),
+                                                     (6, 101, 200)))
+        self.assertFalse(tupleslicer.tuples_conflict((6,), (7, 6)))
+
+    ## Compare all pairs of tuples of one to three elements, using
+    ## values at both ends of the field, so that a field leaking into
+    ## its neighbour would show up.
+    def test_matches_prefix_definition(self):
+        top = tupleslicer.TUPLE_FIELD_MAX
+        values = (0, 1, top - 1, top)
+        tups = [ (a,) for a in values ]
+        tups += [ (a, b) for a in values for b in values ]
+        tups += [ (a, b, c) for a in values for b in values
+                  for c in values ]
+        packed = { tup: tupleslicer.pack_tuple(tup) for tup in tups }
+        for tup1 in tups:
+            for tup2 in tups:
+                expected = prefix_conflict(tup1, tup2)
+                self.assertEqual(tupleslicer.tuples_conflict(tup1, tup2),
+                                 expected, (tup1, tup2))
+                self.assertEqual(
+                    tupleslicer.packed_tuples_conflict(packed[tup1],
+                                                       packed[tup2]),
+                    expected, (tup1, tup2))
+
+    ## create_slice only compares neighbours after sorting.  Check it
+    ## rejects exactly the sets with a conflicting pair, using small
+    ## fields so that nested prefixes are common.
+    def test_create_slice_matches_pairwise(self):
+        rng = random.Random(1)
+        top = tupleslicer.TUPLE_FIELD_MAX
+        values = (0, 1, top)
+        for _ in range(2000):
+            tups = set()
+            for _ in range(rng.randint(1, 6)):
+                tups.add(tuple(rng.choice(values)
+                               for _ in range(rng.randint(1, 3))))
+            expected = any(prefix_conflict(tup1, tup2)
+                           for tup1 in tups for tup2 in tups
+                           if tup1 != tup2)
+            slize = tupleslicer.SwitchStatus().create_slice(tups)
+            self.assertEqual(slize is None, expected, tups)
+
+## A datapath that records the messages sent to it
+class FakeDatapath:
+    def __init__(self, dpid=1):
+        self.id = dpid
+        self.ofproto = ofproto_v1_3
+        self.ofproto_parser = ofproto_v1_3_parser
+        self.xid = 0
+        self.sent = []
+
+    def set_xid(self, msg):
+        self.xid += 1
+        msg.set_xid(self.xid)
+        return self.xid
+
+    def send_msg(self, msg):
+        if msg.xid is None:
+            self.set_xid(msg)
+        msg.serialize()
+        self.sent.append(msg)
+        return True
+
+## Drive the application through its event handlers and REST API,
+## with a switch of eight ports attached.
+class SlicerTest(unittest.TestCase):
+    def setUp(self):
+        wsgi = SimpleNamespace(register=lambda *args, **kwargs: None)
+        self.app = tupleslicer.TupleSlicer(wsgi=wsgi)
+        self.dp = FakeDatapath()
+        ports = [ SimpleNamespace(port_no=p) for p in range(1, 9) ]
+        self.app.datapath_handler(SimpleNamespace(dp=self.dp, enter=True,
+                                                  ports=ports))
+        self.status = self.app.switches[self.dp.id]
+        data = { tupleslicer.tuple_slicer_instance_name: self.app }
+        self.ctrl = tupleslicer.SliceController(None, None, data)
+
+    ## Invoke the REST API, leaving out the HTTP response.
+    def set_config(self, config):
+        req = SimpleNamespace(body=b'{}', json=config)
+        with mock.patch.object(tupleslicer, 'Response', dict):
+            return self.ctrl.set_config(req,
+                                        dpid=dpid_lib.dpid_to_str(self.dp.id))
+
+    ## Let spawned threads run to completion.
+    def settle(self):
+        for _ in range(20):
+            hub.sleep(0)
+
+    def slice_config(self, *tups):
+        return { 'slices': [ [ { 'circuit': list(tup) } for tup in tups ] ] }
+
+    ## A flow can expire after its tuple has been removed by the REST
+    ## API, but before revalidation has released the tuple's group.
+    def test_flow_removed_before_revalidation(self):
+        self.set_config(self.slice_config((1,), (2,), (3,)))
+        self.settle()
+        group = self.status.get_group_for_tuple((3,))
+        self.assertIsNotNone(group)
+
+        self.set_config({ 'disused': [ [3] ] })
+        self.assertEqual(self.status.get_tuple_for_group(group), (3,))
+        msg = SimpleNamespace(datapath=self.dp,
+                              reason=ofproto_v1_3.OFPRR_IDLE_TIMEOUT,
+                              cookie=group,
+                              match={ 'eth_src': '00:00:00:00:00:01' })
+        self.app.flow_removed_handler(SimpleNamespace(msg=msg))
+
+        self.settle()
+        self.assertIsNone(self.status.get_tuple_for_group(group))
+
+    ## Get the T2 rules sent for a destination address.
+    def dst_rules(self, mac):
+        return [ msg for msg in self.dp.sent
+                 if isinstance(msg, ofproto_v1_3_parser.OFPFlowMod)
+                 and msg.table_id == 2
+                 and msg.command == ofproto_v1_3.OFPFC_ADD
+                 and msg.match.get('eth_dst') == mac ]
+
+    ## Addresses seen during a revalidation are learned together, by
+    ## one thread, once it has finished.
+    def test_learn_deferred_by_revalidation(self):
+        self.set_config(self.slice_config((1,), (2,), (3,)))
+        self.settle()
+        macs = [ '00:00:00:00:00:%02x' % i for i in range(1, 6) ]
+
+        with mock.patch.object(hub, 'spawn', wraps=hub.spawn) as spawn:
+            with self.status.revalidation:
+                for mac in macs:
+                    self.app._learn(self.dp, (1,), mac)
+                    self.app._learn(self.dp, (1,), mac)
+                self.assertEqual(len(self.status.deferred_learns),
+                                 len(macs))
+                self.assertEqual(spawn.call_count, 1)
+                self.assertEqual(self.dst_rules(macs[0]), [])
+            self.settle()
+
+        self.assertEqual(self.status.deferred_learns, { })
+        for mac in macs:
+            self.assertEqual(len(self.dst_rules(mac)), 3)
+
+    def count_barriers(self):
+        return sum(isinstance(msg, ofproto_v1_3_parser.OFPBarrierRequest)
+                   for msg in self.dp.sent)
+
+    ## A barrier follows learning only when asked for.
+    def test_learn_barrier(self):
+        self.set_config(self.slice_config((1,), (2,), (3,)))
+        self.settle()
+        before = self.count_barriers()
+        self.app._learn(self.dp, (1,), '00:00:00:00:00:01')
+        self.assertEqual(len(self.dst_rules('00:00:00:00:00:01')), 3)
+        self.assertEqual(self.count_barriers(), before)
+        self.app._learn(self.dp, (2,), '00:00:00:00:00:02', barrier=True)
+        self.assertEqual(self.count_barriers(), before + 1)
+        self.assertIsInstance(self.dp.sent[-1],
+                              ofproto_v1_3_parser.OFPBarrierRequest)
+
+    ## Once enabled, bundles wrap the changes made through the API.
+    def test_bundles(self):
+        self.set_config({ 'bundles': True })
+        self.assertTrue(self.status.use_bundles)
+        before = len(self.dp.sent)
+        self.set_config(self.slice_config((1,), (2,), (3,)))
+        self.settle()
+        sent = self.dp.sent[before:]
+        self.assertGreater(len(sent), 2)
+        ctrl = ofproto_v1_3_parser.ONFBundleCtrlMsg
+        self.assertIsInstance(sent[0], ctrl)
+        self.assertEqual(sent[0].type, ofproto_v1_3.ONF_BCT_OPEN_REQUEST)
+        self.assertIsInstance(sent[-1], ctrl)
+        self.assertEqual(sent[-1].type, ofproto_v1_3.ONF_BCT_COMMIT_REQUEST)
+        for msg in sent[1:-1]:
+            self.assertIsInstance(msg, ofproto_v1_3_parser.ONFBundleAddMsg)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -239,6 +239,10 @@
 
 import logging
 import json
+import functools
+import heapq
+import collections
+import contextlib
 
 from ryu.base import app_manager
 from ryu.controller import ofp_event
@@ -246,6 +250,7 @@ from ryu.controller import dpset
 from ryu.controller.handler import MAIN_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_3
+from ryu.ofproto import ofproto_v1_3_parser
 from ryu.ofproto import ether
 from ryu.lib.packet import ipv4
 from ryu.lib.packet import packet
@@ -254,6 +259,7 @@ from ryu.lib.packet import ether_types
 from ryu.app.ofctl import api
 from ryu.app.wsgi import ControllerBase, WSGIApplication, route
 from ryu.lib import dpid as dpid_lib
+from ryu.lib import hub
 from webob import Response
 
 LOG = logging.getLogger(__name__)
@@ -262,38 +268,106 @@ tuple_slicer_instance_name = 'slicer_api_app'
 url = '/slicer/api/v1/config/{dpid}'
 
 def tuples_text(tups):
-    r = ''
-    s = ''
-    for tup in tups:
-        r += s
-        s = ', '
-        r += tuple_text(tup)
-    return r
+    return ', '.join(map(tuple_text, tups))
+
+## Convert circuits decoded from JSON, which are lists, into a set of
+## tuples.
+def coerce_tuples(circuits):
+    return frozenset(tuple(circuit) for circuit in circuits)
 
 def tuple_text(tup):
-    r = '%d' % tup[0]
-    if len(tup) > 1:
-        r += '.%d' % tup[1]
-        if len(tup) > 2:
-            r += '.%d' % tup[2]
-    return r
+    return '.'.join(f'{elem:d}' for elem in tup)
+
+_hex_octets = tuple(f'{octet:02x}' for octet in range(256))
+
+## Format six raw octets as a MAC address, in the same form as Ryu's
+## packet library.
+def mac_text(octets):
+    return ':'.join([_hex_octets[octet] for octet in octets])
+
+## Get the table identifying traffic from a tuple.  Double-tagged
+## tuples are identified in T1, after T0 has popped the outer tag.
+def tuple_table(tup):
+    return 0 if len(tup) < 3 else 1
+
+## Rules are labelled with cookies, usually a tuple's group id, and
+## deleted by exact cookie.
+_COOKIE_MASK = (1 << 64) - 1
+
+## The cookie of T2 rules that pass packets from a tuple to its group,
+## distinguishing them from learned rules labelled with a group id
+_BROADCAST_COOKIE = _COOKIE_MASK
+
+## Cover a set of group ids exactly with (cookie, cookie_mask) pairs.
+## Each pair matches an aligned block of ids whose size is a power of
+## two, so a run of consecutive ids needs only a few pairs.
+def cookie_blocks(ids):
+    ids = sorted(ids)
+    blocks = []
+    i = 0
+    while i < len(ids):
+        start = ids[i]
+        size = 1
+        while start % (size * 2) == 0 and i + size * 2 <= len(ids) and \
+              ids[i + size * 2 - 1] == start + size * 2 - 1:
+            size *= 2
+        blocks.append((start, _COOKIE_MASK ^ (size - 1)))
+        i += size
+    return blocks
+
+## Tuples are packed into integers for conflict checking.  Each
+## element gets a field of TUPLE_FIELD_BITS bits, the port being the
+## most significant, and absent elements are zero.  The lowest two
+## bits hold the tuple's length.
+TUPLE_FIELD_BITS = 32
+TUPLE_FIELD_MAX = (1 << TUPLE_FIELD_BITS) - 1
+
+def pack_tuple(tup):
+    elems = tuple(tup) + (0, 0)
+    return (elems[0] << (2 * TUPLE_FIELD_BITS + 2)) | \
+        (elems[1] << (TUPLE_FIELD_BITS + 2)) | \
+        (elems[2] << 2) | len(tup)
+
+## Indexed by the shorter length of two tuples, these select the
+## fields that must be equal for the tuples to conflict.
+_conflict_masks = (0,
+                   TUPLE_FIELD_MAX << (2 * TUPLE_FIELD_BITS + 2),
+                   TUPLE_FIELD_MAX << (2 * TUPLE_FIELD_BITS + 2) | \
+                   TUPLE_FIELD_MAX << (TUPLE_FIELD_BITS + 2),
+                   TUPLE_FIELD_MAX << (2 * TUPLE_FIELD_BITS + 2) | \
+                   TUPLE_FIELD_MAX << (TUPLE_FIELD_BITS + 2) | \
+                   TUPLE_FIELD_MAX << 2)
+
+## Two tuples conflict if they have the same port, and the elements
+## they both have are the same, e.g., (6) conflicts with (6, 100),
+## and (6, 100) with (6, 100, 200), but (6, 100) does not conflict
+## with (6, 101, 200).  The arguments are packed tuples.
+def packed_tuples_conflict(pk1, pk2):
+    return (pk1 ^ pk2) & _conflict_masks[min(pk1 & 3, pk2 & 3)] == 0
 
 def tuples_conflict(tup1, tup2):
-    if tup1[0] != tup2[0]:
-        return False
-    if len(tup1) == 1:
-        return True
-    if len(tup2) == 1:
-        return True
-    if tup1[1] != tup2[1]:
-        return False
-    if len(tup1) == 2:
-        return True
-    if len(tup2) == 2:
-        return True
-    return tup1[2] == tup2[2]
+    return packed_tuples_conflict(pack_tuple(tup1), pack_tuple(tup2))
+
+## An OpenFlow 1.3 match that is serialized once, on creation.  Each
+## message using it copies in the resulting bytes, rather than
+## encoding each field again.  It must not be modified.
+class PreparedMatch(ofproto_v1_3_parser.OFPMatch):
+    def __init__(self, **kwargs):
+        super(PreparedMatch, self).__init__(**kwargs)
+        buf = bytearray()
+        super(PreparedMatch, self).serialize(buf, 0)
+        self._wire = bytes(buf)
+
+    def serialize(self, buf, offset):
+        if len(buf) < offset:
+            buf += bytearray(offset - len(buf))
+        buf[offset:offset + len(self._wire)] = self._wire
+        return len(self._wire)
 
 class Slice:
+    __slots__ = ('switch', 'target', 'established', 'sanitized',
+                 'mac_tup', 'target_gen', 'sanitized_gens')
+
     def __init__(self, outer):
         self.switch = outer
 
@@ -307,6 +381,11 @@ class Slice:
         ## Keep track of the tuple on which a MAC was last seen.
         self.mac_tup = { }
 
+        ## Incremented whenever the target set changes, so that
+        ## sanitize can tell whether its last result still holds
+        self.target_gen = 0
+        self.sanitized_gens = None
+
     def see(self, mac, tup):
         oldtup = self.mac_tup.get(mac)
         self.mac_tup[mac] = tup
@@ -326,6 +405,12 @@ class Slice:
         return frozenset(self.target)
 
     def sanitize(self):
+        ## Do nothing if neither the target set nor the switch's
+        ## ports have changed since last time.
+        gens = (self.target_gen, self.switch.ports_gen)
+        if gens == self.sanitized_gens:
+            return
+
         ## Reduce the target set of tuples to those with ports that
         ## actually exist, while retaining the intended target.
         self.sanitized = set()
@@ -333,9 +418,17 @@ class Slice:
             if tup[0] not in self.switch.known_ports:
                 continue
             self.sanitized.add(tup)
-        self.sanitized = frozenset(self.sanitized)
+        self.sanitized_gens = gens
         return
 
+    ## Sanitize the target set, and compare it with the established
+    ## set.  Return the tuples that have been removed from the slice,
+    ## and whether the slice's static rules must change.
+    def diff(self):
+        self.sanitize()
+        return (self.established - self.target,
+                self.sanitized != self.established)
+
     def match(self):
         self.established = set(self.sanitized)
 
@@ -354,8 +447,8 @@ class Slice:
     ## tuple, a single rule is required to explicitly drop the
     ## traffic.  This function only deletes rules, and releases
     ## groups.  Use add_static_rules to create rules and allocate
-    ## groups.
-    def delete_static_rules(self):
+    ## groups.  Messages are appended to msgs for the caller to send.
+    def delete_static_rules(self, msgs):
         if self.sanitized == self.established:
             ## Nothing has actually changed.
             return
@@ -363,8 +456,9 @@ class Slice:
         dp = self.switch.datapath
         ofp = dp.ofproto
         parser = dp.ofproto_parser
-        LOG.info("%016x: %s -> %s", dp.id,
-                 tuples_text(self.established), tuples_text(self.sanitized))
+        if LOG.isEnabledFor(logging.INFO):
+            LOG.info("%016x: %s -> %s", dp.id, tuples_text(self.established),
+                     tuples_text(self.sanitized))
 
         ## Work out which tuples are now invalid.
         if len(self.established) == 2:
@@ -388,7 +482,7 @@ class Slice:
                 out_port = ofp.OFPP_ANY
             else:
                 cookie = group
-                cookie_mask = 0xffffffffffffffff
+                cookie_mask = _COOKIE_MASK
                 out_port = ofp.OFPP_CONTROLLER
             msg = parser.OFPFlowMod(command=ofp.OFPFC_DELETE,
                                     cookie=cookie,
@@ -399,7 +493,7 @@ class Slice:
                                     buffer_id=ofp.OFPCML_NO_BUFFER,
                                     out_port=out_port,
                                     out_group=ofp.OFPG_ANY)
-            dp.send_msg(msg)
+            msgs.append(msg)
 
 
         if len(self.sanitized) <= 2 and len(self.established) > 2:
@@ -420,21 +514,21 @@ class Slice:
                 msg = parser.OFPGroupMod(datapath=dp,
                                          command=ofp.OFPGC_DELETE,
                                          group_id=group)
-                dp.send_msg(msg)
+                msgs.append(msg)
 
                 ## Remove the T2 rules that match the group and a
                 ## destination MAC address.
-                match = parser.OFPMatch(metadata=group)
+                match = self.switch.group_match(group)
                 msg = parser.OFPFlowMod(command=ofp.OFPFC_DELETE,
-                                        cookie=0xffffffffffffffff,
-                                        cookie_mask=0xffffffffffffffff,
+                                        cookie=_BROADCAST_COOKIE,
+                                        cookie_mask=_COOKIE_MASK,
                                         datapath=dp,
                                         table_id=2,
                                         match=match,
                                         buffer_id=ofp.OFPCML_NO_BUFFER,
                                         out_port=ofp.OFPP_ANY,
                                         out_group=ofp.OFPG_ANY)
-                dp.send_msg(msg)
+                msgs.append(msg)
 
     ## Ensure that this slice has the right set of static rules, based
     ## on its tuple set.  If the number of tuple is greater than two,
@@ -443,7 +537,8 @@ class Slice:
     ## rules must exist, exchanging traffic between them.  This
     ## function only adds rules, and allocates groups.  Use
     ## delete_static_rules to delete rules and release groups.
-    def add_static_rules(self):
+    ## Messages are appended to msgs for the caller to send.
+    def add_static_rules(self, msgs):
         ## Get meters for all tuples.
         outmtrs = {}
         inmtrs = {}
@@ -470,27 +565,29 @@ class Slice:
             ## rules.
             tups = list(self.sanitized)
             for i in [ 0, 1 ]:
-                self.switch.ensure_first_tag_rule(tups[i])
+                self.switch.ensure_first_tag_rule(tups[i], msgs)
                 LOG.info("%016x: adding e-line for %s->%s", dp.id,
                          tuple_text(tups[i]), tuple_text(tups[1-i]))
                 (match, tbl, prio) = self.switch.tuple_match(tups[i])
-                actions = self.switch.tuple_action(tups[1-i], tups[i][0])
+                actions = []
 
-                ## Apply egress meter as action if feature available.
-                if hasattr(parser, 'OFPActionMeter') and tups[1-i] in outmtrs:
-                    mtr = outmtrs[tups[1-i]]
-                    actions.insert(0, parser.OFPActionMeter(mtr))
+                ## Apply ingress meter as action if feature available.
+                if hasattr(parser, 'OFPActionMeter') and tups[i] in inmtrs:
+                    mtr = inmtrs[tups[i]]
+                    actions.append(parser.OFPActionMeter(mtr))
 
                 ## Because we're short-circuiting the process by not
                 ## going to T2, we also have to pop off an inner VLAN
                 ## tag if the ingress circuit has it.
                 if len(tups[i]) >= 2:
-                    actions.insert(0, parser.OFPActionPopVlan())
+                    actions.append(parser.OFPActionPopVlan())
 
-                ## Apply ingress meter as action if feature available.
-                if hasattr(parser, 'OFPActionMeter') and tups[i] in inmtrs:
-                    mtr = inmtrs[tups[i]]
-                    actions.insert(0, parser.OFPActionMeter(mtr))
+                ## Apply egress meter as action if feature available.
+                if hasattr(parser, 'OFPActionMeter') and tups[1-i] in outmtrs:
+                    mtr = outmtrs[tups[1-i]]
+                    actions.append(parser.OFPActionMeter(mtr))
+
+                actions += self.switch.tuple_action(tups[1-i], tups[i][0])
 
                 inst = [parser.OFPInstructionActions(ofp.OFPIT_APPLY_ACTIONS,
                                                      actions)]
@@ -514,7 +611,7 @@ class Slice:
                                         priority=prio,
                                         match=match,
                                         instructions=inst)
-                dp.send_msg(msg)
+                msgs.append(msg)
             return
 
         ## Identify the set of new tuples.
@@ -532,9 +629,10 @@ class Slice:
             ## target set, except for the one represented by the
             ## source tuple.
             (group, added) = self.switch.claim_group_for_tuple(stup)
-            LOG.info("%016x: updating group %d tuple %s->%s", dp.id,
-                     group, tuple_text(stup),
-                     tuples_text(self.sanitized - set([stup])))
+            if LOG.isEnabledFor(logging.INFO):
+                LOG.info("%016x: updating group %d tuple %s->%s", dp.id,
+                         group, tuple_text(stup),
+                         tuples_text(t for t in self.sanitized if t != stup))
             cmd = ofp.OFPGC_ADD if added else ofp.OFPGC_MODIFY
             buckets = []
             for dtup in self.sanitized:
@@ -543,14 +641,14 @@ class Slice:
                 actions = self.switch.tuple_action(dtup, stup[0])
                 ## Apply egress meter to this bucket.
                 if hasattr(parser, 'OFPActionMeter') and dtup in outmtrs:
-                    actions.insert(0, parser.OFPActionMeter(outmtrs[dtup]))
+                    actions = [parser.OFPActionMeter(outmtrs[dtup])] + actions
                 buckets.append(parser.OFPBucket(actions=actions))
             msg = parser.OFPGroupMod(datapath=dp,
                                      command=cmd,
                                      type_=ofp.OFPGT_ALL,
                                      group_id=group,
                                      buckets=buckets)
-            dp.send_msg(msg)
+            msgs.append(msg)
 
             if added:
                 ## Make sure that unknown destinations in this slice
@@ -559,7 +657,7 @@ class Slice:
                 ## T2.  This rule will automatically be deleted when
                 ## the group is deleted, because it refers to the
                 ## group in its actions.
-                match = parser.OFPMatch(metadata=group)
+                match = self.switch.group_match(group)
                 actions = [parser.OFPActionGroup(group)]
                 inst = [parser.OFPInstructionActions(ofp.OFPIT_APPLY_ACTIONS,
                                                      actions)]
@@ -574,13 +672,13 @@ class Slice:
                         inst.insert(0,
                                     parser.OFPInstructionMeter(outmtrs[ctup]))
                 msg = parser.OFPFlowMod(command=ofp.OFPFC_ADD,
-                                        cookie=0xffffffffffffffff,
+                                        cookie=_BROADCAST_COOKIE,
                                         datapath=dp,
                                         table_id=2,
                                         priority=1,
                                         match=match,
                                         instructions=inst)
-                dp.send_msg(msg)
+                msgs.append(msg)
 
         for stup in newports:
             ## A copy of the header of a packet from this tuple with
@@ -610,22 +708,27 @@ class Slice:
                                     priority=prio,
                                     match=match,
                                     instructions=inst)
-            dp.send_msg(msg)
-            self.switch.ensure_first_tag_rule(stup)
+            msgs.append(msg)
+            self.switch.ensure_first_tag_rule(stup, msgs)
 
 
     ## Ensure that a tuple belongs to this slice.  If it belongs to
-    ## something else, get that to abandon it.
-    def adopt(self, tup):
+    ## something else, get that to abandon it.  The caller may supply
+    ## the packed tuple if it already has it.
+    def adopt(self, tup, pk=None):
         ## Make no changes if we already have this tuple.
         if tup in self.target:
             return
 
         ## Check all tuples of all slices for conflicts.  Force slices
         ## with those tuples to abandon them.
+        ## Only tuples on the same port can conflict.
+        if pk is None:
+            pk = pack_tuple(tup)
         abd = []
-        for tup2, slize in self.switch.target_index.iteritems():
-            if tuples_conflict(tup, tup2):
+        for tup2, pk2 in self.switch.port_index.get(tup[0], {}).items():
+            if packed_tuples_conflict(pk, pk2):
+                slize = self.switch.target_index[tup2]
                 if tup == tup2 and slize == self:
                     continue
                 abd.append((slize, tup2))
@@ -635,7 +738,15 @@ class Slice:
         ## Record that this slice owns this tuple now, and that we
         ## need to be revalidated.
         self.target.add(tup)
+        self.target_gen += 1
         self.switch.target_index[tup] = self
+        self.switch.port_index.setdefault(tup[0], { })[tup] = pk
+        if len(tup) > 1:
+            head = tup[0:2]
+            self.switch.target_heads[head] += 1
+            self.switch.invalid_first_tag_rules.discard(head)
+        self.switch.slices.add(self)
+        self.switch.invalidate_config()
         self.switch.invalid_slices.add(self)
 
     def abandon(self, tup):
@@ -646,22 +757,79 @@ class Slice:
         ## Record that this slice no longer owns this tuple now, and
         ## that we need to be revalidated.
         self.target.discard(tup)
+        self.target_gen += 1
         us = self.switch.target_index.pop(tup)
         assert us == self
+        ptups = self.switch.port_index[tup[0]]
+        del ptups[tup]
+        if len(ptups) == 0:
+            del self.switch.port_index[tup[0]]
+        if len(tup) > 1:
+            head = tup[0:2]
+            heads = self.switch.target_heads
+            heads[head] -= 1
+            if heads[head] == 0:
+                del heads[head]
+        if len(self.target) == 0:
+            self.switch.slices.discard(self)
+        self.switch.invalidate_config()
         self.switch.invalid_slices.add(self)
         return
 
 class SwitchStatus:
+    __slots__ = ('datapath', 'unknown_src_to_ctrl',
+                 'use_bundles', 'next_bundle', 'pending',
+                 'known_ports', 'ports_gen',
+                 'free_meters', 'inmeters', 'outmeters',
+                 'target_index', 'port_index', 'target_heads', 'slices',
+                 '_config_cache', 'invalid_slices', 'invalid_first_tag_rules',
+                 'revalidation', 'deferred_learns',
+                 'tuple_to_group', 'group_to_tuple', 'free_groups',
+                 'next_group', 'group_matches',
+                 '_caches')
+
+    ## Methods whose results are cached per datapath, each built by
+    ## the method of the same name prefixed with '_build_'
+    _CACHED = ('tuple_match', 'tuple_action',
+               'first_tag_match', 'first_tag_instructions')
+
     def __init__(self):
         self.datapath = None
 
         self.unknown_src_to_ctrl = False
 
-        ## Keep a set of ports known to belong to the switch.
+        ## Set to apply each batch of changes as an ONF bundle, which
+        ## the switch commits atomically and in order.  Not all
+        ## OpenFlow 1.3 switches support this extension, so it is
+        ## only enabled through the REST API.
+        self.use_bundles = False
+        self.next_bundle = 0
+
+        ## Messages to be sent to the switch by the next flush
+        self.pending = []
+
+        ## Held while revalidating, which may yield to other threads
+        ## part-way through
+        self.revalidation = hub.Semaphore(1)
+
+        ## Addresses to be learned once revalidation has finished, as
+        ## (tuple, MAC) -> timeout
+        self.deferred_learns = { }
+
+        ## Keep a set of ports known to belong to the switch, and
+        ## count changes to it.
         self.known_ports = set()
+        self.ports_gen = 0
 
-        ## These groups and anything after the largest value are free.
-        self.free_groups = set([ 0 ])
+        ## Released groups are kept in a heap, so the lowest can be
+        ## reused first.  Groups from next_group onwards have never
+        ## been allocated.
+        self.free_groups = []
+        self.next_group = 0
+
+        ## Matches on metadata set to each group id, indexed by group
+        ## id.  These remain valid when a group is reused.
+        self.group_matches = []
         ## Record the tuple-group mapping in both directions.
         self.group_to_tuple = { }
         self.tuple_to_group = { }
@@ -676,52 +844,88 @@ class SwitchStatus:
         ## tuple -> Slice
         self.target_index = { }
 
+        ## port -> tuple in target_index on that port -> packed tuple
+        self.port_index = { }
+
+        ## (port, vlan) -> number of tuples in target_index starting
+        ## with it, i.e., needing or sharing the T0 rule with that
+        ## match
+        self.target_heads = collections.Counter()
+
+        ## Slices with at least one tuple, i.e., the distinct values
+        ## of target_index
+        self.slices = set()
+
+        ## The result of get_config, until the slices change
+        self._config_cache = None
+
         ## Keep track of slices that might be out-of-date.
         self.invalid_slices = set()
 
-        ## Keep track of (port, vlan) rules that might have become
-        ## redundant.
+        ## Keep track of (port, vlan) rules that have become redundant.
         self.invalid_first_tag_rules = set()
 
+        self.reset_caches()
+
     def set_datapath(self, dp):
         self.datapath = dp
         self.known_ports = set()
+        self.ports_gen += 1
+        self.pending = []
+        self.deferred_learns = { }
+        self.reset_caches()
+
+    ## Discard matches and actions built so far.  These are created
+    ## by the datapath's parser, so they must not outlive it.
+    def reset_caches(self):
+        self._caches = { name: functools.lru_cache(maxsize=4096)(
+                             getattr(self, '_build_' + name))
+                         for name in self._CACHED }
 
     ## Create a match for a rule in either T0/T1 implementing
     ## E-Line/drop rules.  Return the match, which table it goes in,
-    ## and what priority to use.
+    ## and what priority to use.  The same (tup, mac) yields the same
+    ## match object, already serialized, so callers must not modify
+    ## it.
     def tuple_match(self, tup, mac=None):
-        dp = self.datapath
-        parser = dp.ofproto_parser
+        return self._caches['tuple_match'](tup, mac)
+
+    def _build_tuple_match(self, tup, mac):
+        tbl = tuple_table(tup)
         if len(tup) == 1:
             if mac is None:
-                return (parser.OFPMatch(in_port=tup[0]), 0, 4)
+                return (PreparedMatch(in_port=tup[0]), tbl, 4)
             else:
-                return (parser.OFPMatch(in_port=tup[0], eth_src=mac), 0, 5)
+                return (PreparedMatch(in_port=tup[0], eth_src=mac), tbl, 5)
         if len(tup) == 2:
             if mac is None:
-                return (parser.OFPMatch(in_port=tup[0],
-                                        vlan_vid=0x1000|tup[1]), 0, 4)
+                return (PreparedMatch(in_port=tup[0],
+                                      vlan_vid=0x1000|tup[1]), tbl, 4)
             else:
-                return (parser.OFPMatch(in_port=tup[0],
-                                        eth_src=mac,
-                                        vlan_vid=0x1000|tup[1]), 0, 5)
+                return (PreparedMatch(in_port=tup[0],
+                                      eth_src=mac,
+                                      vlan_vid=0x1000|tup[1]), tbl, 5)
         if mac is None:
-            return (parser.OFPMatch(in_port=tup[0],
-                                    metadata=tup[1],
-                                    vlan_vid=0x1000|tup[2]), 1, 4)
+            return (PreparedMatch(in_port=tup[0],
+                                  metadata=tup[1],
+                                  vlan_vid=0x1000|tup[2]), tbl, 4)
         else:
-            return (parser.OFPMatch(in_port=tup[0],
-                                    eth_src=mac,
-                                    metadata=tup[1],
-                                    vlan_vid=0x1000|tup[2]), 1, 5)
+            return (PreparedMatch(in_port=tup[0],
+                                  eth_src=mac,
+                                  metadata=tup[1],
+                                  vlan_vid=0x1000|tup[2]), tbl, 5)
 
     ## Create an action list for output to a particular tuple.  If the
     ## port of the tuple is the same as a given input port, explicitly
     ## output to IN_PORT, rather than the tuple's port (or the bucket
     ## will be ignored).  This kind of action list is used as buckets
-    ## in the group table, and for learned rules in T2.
+    ## in the group table, and for learned rules in T2.  The same
+    ## list is returned for the same arguments, so callers must not
+    ## modify it, but build a new list to add further actions.
     def tuple_action(self, tup, in_port):
+        return self._caches['tuple_action'](tup, in_port)
+
+    def _build_tuple_action(self, tup, in_port):
         dp = self.datapath
         ofp = dp.ofproto
         parser = dp.ofproto_parser
@@ -738,11 +942,38 @@ class SwitchStatus:
                 parser.OFPActionSetField(vlan_vid=0x1000|tup[1]), \
                 parser.OFPActionOutput(out_port)]
 
+    ## Create the match and instructions of a T0 rule that pops the
+    ## outer tag of a double-tagged tuple, and passes the outer VLAN
+    ## to T1 as metadata.  Both are shared, so callers must not
+    ## modify them.
+    def first_tag_match(self, port, vlan):
+        return self._caches['first_tag_match'](port, vlan)
+
+    def _build_first_tag_match(self, port, vlan):
+        return PreparedMatch(in_port=port, vlan_vid=0x1000|vlan)
+
+    def first_tag_instructions(self, vlan):
+        return self._caches['first_tag_instructions'](vlan)
+
+    def _build_first_tag_instructions(self, vlan):
+        dp = self.datapath
+        ofp = dp.ofproto
+        parser = dp.ofproto_parser
+        actions = [parser.OFPActionPopVlan(), \
+                   parser.OFPActionSetField(metadata=vlan)]
+        return [parser.OFPInstructionActions(ofp.OFPIT_APPLY_ACTIONS,
+                                             actions), \
+                parser.OFPInstructionGotoTable(1)]
+
+    ## Discard the result of get_config, as the slices have changed.
+    def invalidate_config(self):
+        self._config_cache = None
+
     def get_config(self):
-        result = []
-        for slize in set(self.target_index.values()):
-            result.append(list(slize.get_tuples()))
-        return result
+        if self._config_cache is None:
+            self._config_cache = [ list(slize.get_tuples())
+                                   for slize in self.slices ]
+        return self._config_cache
 
     ## Look up a slice by one of its tuples.
     def get_slice(self, tup):
@@ -768,21 +999,22 @@ class SwitchStatus:
             if len(tup) > 3:
                 return None
 
-            ## Valid tuples have no negative elements.
-            if tup[0] < 0:
-                return None
-            if len(tup) > 1 and tup[1] < 0:
-                return None
-            if len(tup) > 2 and tup[2] < 0:
-                return None
-
-            ## Check for conflicts with other tuples.
-            for otup in tups:
-                if tup is otup:
-                    continue
-                if tuples_conflict(tup, otup):
+            ## Valid tuples have no negative elements, and no elements
+            ## too big to pack.
+            for elem in tup:
+                if elem < 0 or elem > TUPLE_FIELD_MAX:
                     return None
 
+        ## Check for conflicts with other tuples.  Once sorted by
+        ## packed value, tuples on the same port are adjacent, and a
+        ## tuple is followed by those it is a prefix of, so only
+        ## neighbours need to be compared.
+        packed = { tup: pack_tuple(tup) for tup in tups }
+        order = sorted(packed.values())
+        for i in range(1, len(order)):
+            if packed_tuples_conflict(order[i - 1], order[i]):
+                return None
+
         ## Ensure meters exist for all tuples that have specified rates.
         self.update_rates(tups, inrates, outrates)
 
@@ -802,17 +1034,17 @@ class SwitchStatus:
             ## Modify the slice with the maximum overlap, and create
             ## another slice with the remaining tuples.
             for tup in tups - best_slize.get_tuples():
-                best_slize.adopt(tup)
+                best_slize.adopt(tup, packed[tup])
             abandoned = best_slize.get_tuples() - tups
             other_slize = Slice(self)
             for tup in abandoned:
-                other_slize.adopt(tup)
+                other_slize.adopt(tup, self.port_index[tup[0]][tup])
             return best_slize
 
         ## No overlapping slice was found, so create a brand-new one.
         slize = Slice(self)
-        for tup in tups:
-            slize.adopt(tup)
+        for tup, pk in packed.items():
+            slize.adopt(tup, pk)
         return slize
 
     def get_meters(self, tup, inmtrs, outmtrs):
@@ -827,11 +1059,9 @@ class SwitchStatus:
         return
 
     def get_inmeter(self, tup):
-        tup = tuple(tup)
         return self.inmeters.get(tup)
 
     def get_outmeter(self, tup):
-        tup = tuple(tup)
         return self.outmeters.get(tup)
 
     def set_inmeter(self, tup, rate):
@@ -847,7 +1077,6 @@ class SwitchStatus:
         self.drop_meter(self.outmeters, tup)
 
     def drop_meter(self, mp, tup):
-        tup = tuple(tup)
         dp = self.datapath
         ofp = dp.ofproto
         parser = dp.ofproto_parser
@@ -867,7 +1096,6 @@ class SwitchStatus:
         ## TODO: Detect lack of implementation of meters.
         if True:
             return None
-        tup = tuple(tup)
         dp = self.datapath
         ofp = dp.ofproto
         parser = dp.ofproto_parser
@@ -900,7 +1128,7 @@ class SwitchStatus:
             bands = [parser.OFPMeterBandDrop(type_=ofp.OFPMBT_DROP,
                                              len_=0,
                                              rate=rate,
-                                             burst_size=rate / 10)]
+                                             burst_size=rate // 10)]
             msg = parser.OFPMeterMod(datapath=dp,
                                      command=cmd,
                                      flags=ofp.OFPMF_KBPS,
@@ -909,6 +1137,41 @@ class SwitchStatus:
         dp.send_msg(msg)
         return mtr
 
+    ## Send several messages to the switch, so that they are all
+    ## processed before anything sent later.  With bundles, they are
+    ## committed as one atomic, ordered bundle.  Otherwise, they are
+    ## followed by a single barrier, unless barrier is False.
+    def send_batch(self, msgs, barrier=True):
+        if len(msgs) == 0:
+            return
+        dp = self.datapath
+        ofp = dp.ofproto
+        parser = dp.ofproto_parser
+        if not self.use_bundles:
+            for msg in msgs:
+                dp.send_msg(msg)
+            if barrier:
+                dp.send_msg(parser.OFPBarrierRequest(dp))
+            return
+
+        bundle = self.next_bundle
+        self.next_bundle = (bundle + 1) & 0xffffffff
+        flags = ofp.ONF_BF_ATOMIC | ofp.ONF_BF_ORDERED
+        dp.send_msg(parser.ONFBundleCtrlMsg(dp, bundle,
+                                            ofp.ONF_BCT_OPEN_REQUEST,
+                                            flags, []))
+        for msg in msgs:
+            dp.send_msg(parser.ONFBundleAddMsg(dp, bundle, flags, msg, []))
+        dp.send_msg(parser.ONFBundleCtrlMsg(dp, bundle,
+                                            ofp.ONF_BCT_COMMIT_REQUEST,
+                                            flags, []))
+
+    ## Send all pending messages as one batch.
+    def flush(self, barrier=True):
+        msgs = self.pending
+        self.pending = []
+        self.send_batch(msgs, barrier=barrier)
+
     ## Get the group id for a given tuple, without attempting to
     ## allocate one if not already allocated.
     def get_group_for_tuple(self, tup):
@@ -919,19 +1182,18 @@ class SwitchStatus:
 
     ## Get or claim a group id for a given tuple.
     def claim_group_for_tuple(self, tup):
-        tup = tuple(tup)
         ## Already allocated?
-        if self.tuple_to_group.has_key(tup):
+        if tup in self.tuple_to_group:
             return (self.tuple_to_group.get(tup), False)
 
-        ## Get the lowest free group.
-        group = min(self.free_groups)
-        self.free_groups.discard(group)
-
-        ## If we appear to have run out, just add back in one more
-        ## than what we took.
-        if len(self.free_groups) == 0:
-            self.free_groups.add(group + 1)
+        ## Get the lowest free group.  Released groups are always
+        ## lower than any never allocated.
+        if len(self.free_groups) > 0:
+            group = heapq.heappop(self.free_groups)
+        else:
+            group = self.next_group
+            self.next_group += 1
+            self.group_matches.append(PreparedMatch(metadata=group))
         LOG.info("%016x: claiming group %d tuple %s",
                  self.datapath.id, group, tuple_text(tup))
 
@@ -939,17 +1201,21 @@ class SwitchStatus:
         self.group_to_tuple[group] = tup;
         return (group, True)
 
+    ## Get a match for packets tagged with a group id in their
+    ## metadata, i.e., from the group's tuple on their way to T2.
+    def group_match(self, group):
+        return self.group_matches[group]
+
     ## Release the group id allocated to a given tuple.  Return the
     ## formerly allocated group id.
     def release_group_by_tuple(self, tup):
-        tup = tuple(tup)
         if tup not in self.tuple_to_group:
             return
         group = self.tuple_to_group.pop(tup)
         LOG.info("%016x: releasing group %d tuple %s",
                  self.datapath.id, group, tuple_text(tup))
         self.group_to_tuple.pop(group)
-        self.free_groups.add(group)
+        heapq.heappush(self.free_groups, group)
         return group
 
     ## Release a given group id from its tuple.  Return the tuple it
@@ -961,7 +1227,7 @@ class SwitchStatus:
         LOG.info("%016x: releasing group %d tuple %s",
                  self.datapath.id, group, tuple_text(tup))
         self.tuple_to_group.pop(tup)
-        self.free_groups.add(group)
+        heapq.heappush(self.free_groups, group)
         return tup
 
     ## Record that a port was attached to the switch.
@@ -971,6 +1237,11 @@ class SwitchStatus:
         dp = self.datapath
         LOG.info("%016x: gained port %d", dp.id, port)
         self.known_ports.add(port)
+        self.ports_gen += 1
+
+        ## Invalidate any slice targeted on that port.
+        for tup in self.port_index.get(port, ()):
+            self.invalid_slices.add(self.target_index[tup])
         return
 
     ## Record that a port was detached from the switch.  Remove tuples
@@ -979,19 +1250,16 @@ class SwitchStatus:
         dp = self.datapath
         LOG.info("%016x: lost port %d", dp.id, port)
         self.known_ports.discard(port)
+        self.ports_gen += 1
 
         ## Invalidate any slice targeted on that port.
-        for item in self.target_index.items():
-            tup = item[0]
-            if tup[0] != port:
-                continue
-            slize = item[1]
-            self.invalid_slices.add(slize)
+        for tup in self.port_index.get(port, ()):
+            self.invalid_slices.add(self.target_index[tup])
         return
 
     ## Record that the user no longer wants to connect a tuple.
     def discard_tuple(self, tup):
-        tup = tuple(tup)
+        assert isinstance(tup, tuple)
         slize = self.target_index.get(tup)
         if slize is not None:
             slize.abandon(tup)
@@ -999,94 +1267,164 @@ class SwitchStatus:
 
     ## Invalidate all slices.
     def invalidate(self):
-        for slize in set(self.target_index.values()):
+        for slize in self.slices:
             slize.invalidate()
 
-    def delete_dynamic_rules(self, tup):
+    ## Delete the dynamic rules and groups of tuples that have been
+    ## removed from their slices.
+    def delete_dynamic_rules(self, tups):
         dp = self.datapath
         ofp = dp.ofproto
         parser = dp.ofproto_parser
 
-        ## Delete dynamic rules in T0/T1 matching this tuple and
-        ## passing on to T1/T2.
-        self.invalidate_first_tag_rule(tup)
-        (match, tbl, prio) = self.tuple_match(tup)
-        msg = parser.OFPFlowMod(command=ofp.OFPFC_DELETE,
-                                datapath=dp,
-                                table_id=tbl,
-                                match=match,
-                                buffer_id=ofp.OFPCML_NO_BUFFER,
-                                out_port=ofp.OFPP_ANY,
-                                out_group=ofp.OFPG_ANY)
-        dp.send_msg(msg)
+        groups = []
+        for tup in tups:
+            ## Delete dynamic rules in T0/T1 matching this tuple and
+            ## passing on to T1/T2.
+            self.invalidate_first_tag_rule(tup)
+            (match, tbl, prio) = self.tuple_match(tup)
+            msg = parser.OFPFlowMod(command=ofp.OFPFC_DELETE,
+                                    datapath=dp,
+                                    table_id=tbl,
+                                    match=match,
+                                    buffer_id=ofp.OFPCML_NO_BUFFER,
+                                    out_port=ofp.OFPP_ANY,
+                                    out_group=ofp.OFPG_ANY)
+            self.pending.append(msg)
+
+            group = self.release_group_by_tuple(tup)
+            if group is None:
+                continue
+            groups.append(group)
 
-        group = self.release_group_by_tuple(tup)
-        if group is not None:
             ## Delete the group associated with the tuple.  This also
             ## deletes the rule matching that group and sending to
             ## that group as a broadcast.
             msg = parser.OFPGroupMod(datapath=dp,
                                      command=ofp.OFPGC_DELETE,
                                      group_id=group)
-            dp.send_msg(msg)
+            self.pending.append(msg)
 
-            ## Delete dynamic rules in the destination table
-            ## matching packets to the tuple.
-            match = parser.OFPMatch()
+            ## Delete dynamic rules in the destination table matching
+            ## packets from the tuple.
+            match = self.group_match(group)
             msg = parser.OFPFlowMod(command=ofp.OFPFC_DELETE,
-                                    cookie=group,
-                                    cookie_mask=0xffffffffffffffff,
                                     datapath=dp,
                                     table_id=2,
                                     match=match,
                                     buffer_id=ofp.OFPCML_NO_BUFFER,
                                     out_port=ofp.OFPP_ANY,
                                     out_group=ofp.OFPG_ANY)
-            dp.send_msg(msg)
+            self.pending.append(msg)
 
-            ## Delete dynamic rules in the destination table matching
-            ## packets from the tuple.
-            match = parser.OFPMatch(metadata=group)
+        ## Delete dynamic rules in the destination table matching
+        ## packets to the tuples.  These are labelled with the tuples'
+        ## groups, so runs of groups can be covered by one cookie
+        ## mask each.
+        match = parser.OFPMatch()
+        for (cookie, cookie_mask) in cookie_blocks(groups):
             msg = parser.OFPFlowMod(command=ofp.OFPFC_DELETE,
+                                    cookie=cookie,
+                                    cookie_mask=cookie_mask,
                                     datapath=dp,
                                     table_id=2,
                                     match=match,
                                     buffer_id=ofp.OFPCML_NO_BUFFER,
                                     out_port=ofp.OFPP_ANY,
                                     out_group=ofp.OFPG_ANY)
-            dp.send_msg(msg)
+            self.pending.append(msg)
+
+    ## Make several changes to the slices, and revalidate once they
+    ## have all been made.  Revalidation is asynchronous: it is only
+    ## started in another thread on exit, so the changes may not
+    ## have reached the switch when the block ends, and errors in
+    ## applying them are only logged by that thread.  Nothing is
+    ## revalidated if the changes fail.
+    @contextlib.contextmanager
+    def batch(self):
+        yield self
+        self.revalidate_later()
+
+    ## Revalidate in a separate thread, so that the caller can get on
+    ## with handling other events.
+    def revalidate_later(self):
+        hub.spawn(self.revalidate)
+
+    ## Determine whether revalidation has anything to do.
+    def dirty(self):
+        return len(self.invalid_slices) > 0 or \
+            len(self.invalid_first_tag_rules) > 0
 
     def revalidate(self):
+        with self.revalidation:
+            self._revalidate()
+
+    def _revalidate(self):
         dp = self.datapath
         if dp is None:
             return
+
+        ## If nothing might be out-of-date, just send whatever has
+        ## been queued.
+        if not self.dirty():
+            self.flush()
+            return
         LOG.info("%016x: revalidating...", dp.id)
 
+        ## Take the slices to be dealt with now.  Any invalidated
+        ## while we yield will be dealt with by the next
+        ## revalidation.  If we don't finish, put ours back for that
+        ## revalidation too.
+        invalid_slices = self.invalid_slices
+        self.invalid_slices = set()
+        complete = False
+        try:
+            complete = self._revalidate_slices(dp, invalid_slices)
+        finally:
+            if not complete:
+                self.invalid_slices |= invalid_slices
+
+    ## Bring the switch up to date with a set of invalid slices.
+    ## Return False if the switch went away before we were done.
+    def _revalidate_slices(self, dp, invalid_slices):
         ## Identify all tuples that have been removed from their
-        ## slices, and remove rules pertaining to them.
+        ## slices, and work out the subset of target tuples that
+        ## actually exist.  Slices whose established tuples already
+        ## match need no further work.
         tuples_to_reset = set()
-        for inval in self.invalid_slices:
-            inval_missing = inval.established.difference(inval.target)
-            tuples_to_reset.update(inval_missing)
-        for tup in tuples_to_reset:
-            self.delete_dynamic_rules(tup)
+        changed = []
+        for slize in invalid_slices:
+            (removed, differs) = slize.diff()
+            tuples_to_reset.update(removed)
+            if differs:
+                changed.append(slize)
 
-        ## Work out the subset of target tuples that actually exist.
-        for slize in self.invalid_slices:
-            slize.sanitize()
+        ## Remove rules pertaining to the removed tuples.
+        self.delete_dynamic_rules(tuples_to_reset)
 
         ## Ensure that each modified slice has the right static rules
         ## according to its target set.  This is done in two passes,
-        ## one to delete rules and groups, and one to add them.
-        for slize in self.invalid_slices:
-            slize.delete_static_rules()
-        for slize in self.invalid_slices:
-            slize.add_static_rules()
+        ## one to delete rules and groups, and one to add them.  All
+        ## deletions must come first, as a tuple might have moved
+        ## from one slice to another.
+        for slize in changed:
+            slize.delete_static_rules(self.pending)
+
+        ## Let other events be handled between the passes.  Learning
+        ## is deferred until we have finished, and other revalidations
+        ## wait for us.  If the switch has gone or been replaced
+        ## meanwhile, the rules queued so far are not sent.
+        hub.sleep(0)
+        if self.datapath is not dp:
+            self.invalid_first_tag_rules.clear()
+            return False
+
+        for slize in changed:
+            slize.add_static_rules(self.pending)
 
         ## Make all established tuple sets match the targets.
-        for slize in self.invalid_slices:
+        for slize in changed:
             slize.match()
-        self.invalid_slices.clear()
 
         ## Clear redundant T0 rules that extract the first VLAN tag,
         ## store it as metadata, and pass on to T1.
@@ -1098,21 +1436,19 @@ class SwitchStatus:
         for tup in set(self.inmeters.keys()) - set(self.target_index.keys()):
             self.drop_inmeter(tup)
 
+        ## Send all the changes together.
+        self.flush()
+
         LOG.info("%016x: revalidating complete", dp.id)
-        return
+        return True
 
     ## Check that T0 contains no unnecessary rules matching (in_port,
     ## vlan_vid), popping the VLAN tag while saving it in the
     ## metadata, and passing on to T1 (to check for presence of a
     ## second tag).
     def revalidate_first_tag_rules(self):
-        ## Check all slices to see if they require a T0 rule
-        ## corresponding to the current set of candidates.  Remove
-        ## matching candidates.
-        for slize in set(self.target_index.values()):
-            for tup in slize.get_tuples():
-                self.invalid_first_tag_rules.discard(tup[0:2])
-
+        ## Candidates still required by a slice have already been
+        ## excluded.
         dp = self.datapath
         ofp = dp.ofproto
         parser = dp.ofproto_parser
@@ -1121,10 +1457,7 @@ class SwitchStatus:
         for tup in self.invalid_first_tag_rules:
             LOG.info("%016x: deleting first-tag rule for %s", dp.id,
                      tuple_text(tup))
-            port = tup[0]
-            vlan = tup[1]
-            match = parser.OFPMatch(in_port=port,
-                                    vlan_vid=0x1000|vlan)
+            match = self.first_tag_match(tup[0], tup[1])
             msg = parser.OFPFlowMod(command=ofp.OFPFC_DELETE,
                                     datapath=dp,
                                     table_id=0,
@@ -1132,24 +1465,28 @@ class SwitchStatus:
                                     buffer_id=ofp.OFPCML_NO_BUFFER,
                                     out_port=ofp.OFPP_ANY,
                                     out_group=ofp.OFPG_ANY)
-            dp.send_msg(msg)
+            self.pending.append(msg)
 
         ## Mark all candidates as investigated.
         self.invalid_first_tag_rules.clear()
         return
 
     ## Record that an (in_port, vlan_vid) rule in T0 might not be
-    ## necessary any more.
+    ## necessary any more.  It is not a candidate if a targeted tuple
+    ## still needs it.
     def invalidate_first_tag_rule(self, tup):
         if len(tup) < 3:
             return
-        self.invalid_first_tag_rules.add(tup[0:2])
+        head = tup[0:2]
+        if head not in self.target_heads:
+            self.invalid_first_tag_rules.add(head)
         return
 
     ## Ensure that a rule exists in T0 matching (port, vlan), saving
     ## the VLAN id in the metadata, popping the VLAN tag, and passing
-    ## on to T1 (which will then check for a second tag).
-    def ensure_first_tag_rule(self, tup):
+    ## on to T1 (which will then check for a second tag).  The rule is
+    ## appended to a list of messages to be sent.
+    def ensure_first_tag_rule(self, tup, msgs):
         if len(tup) < 3:
             return
         port = tup[0]
@@ -1161,20 +1498,13 @@ class SwitchStatus:
 
         LOG.info("%016x: adding first-tag rule for %s", dp.id,
                  tuple_text(tup))
-        match = parser.OFPMatch(in_port=port,
-                                vlan_vid=0x1000|vlan)
-        actions = [parser.OFPActionPopVlan(), \
-                   parser.OFPActionSetField(metadata=vlan)]
-        inst = [parser.OFPInstructionActions(ofp.OFPIT_APPLY_ACTIONS,
-                                             actions), \
-                parser.OFPInstructionGotoTable(1)]
         msg = parser.OFPFlowMod(command=ofp.OFPFC_ADD,
                                 datapath=dp,
                                 table_id=0,
                                 priority=4,
-                                match=match,
-                                instructions=inst)
-        dp.send_msg(msg)
+                                match=self.first_tag_match(port, vlan),
+                                instructions=self.first_tag_instructions(vlan))
+        msgs.append(msg)
         return
 
 class TupleSlicer(app_manager.RyuApp):
@@ -1195,22 +1525,36 @@ class TupleSlicer(app_manager.RyuApp):
         ofp = dp.ofproto
         parser = dp.ofproto_parser
 
+    ## Get the status of an attached switch, or None if we don't know
+    ## it.  The status is kept on the datapath while it is attached.
+    def get_status(self, dp):
+        status = getattr(dp, '_slicer_status', None)
+        if status is None:
+            status = self.switches.get(dp.id)
+        return status
+
     @set_ev_cls(dpset.EventPortAdd, dpset.DPSET_EV_DISPATCHER)
     def port_added(self, ev):
         dp = ev.dp
         port = ev.port
-        status = self.switches[dp.id]
+        status = self.get_status(dp)
+        if status is None:
+            return
         status.port_added(port.port_no)
-        status.revalidate()
+        if status.dirty():
+            status.revalidate_later()
         return
 
     @set_ev_cls(dpset.EventPortDelete, dpset.DPSET_EV_DISPATCHER)
     def port_removed(self, ev):
         dp = ev.dp
         port = ev.port
-        status = self.switches[dp.id]
+        status = self.get_status(dp)
+        if status is None:
+            return
         status.port_removed(port.port_no)
-        status.revalidate()
+        if status.dirty():
+            status.revalidate_later()
         return
 
     def drop_dhcp(self, dp):
@@ -1287,14 +1631,20 @@ class TupleSlicer(app_manager.RyuApp):
 
         if not ev.enter:
             ## A switch has been detached.
-            if dp.id not in self.switches:
+            dp._slicer_status = None
+            status = self.switches.get(dp.id)
+            if status is None:
                 return
-            status = self.switches[dp.id]
             status.set_datapath(None)
             return
 
         ## A switch has been attached.  Set up static flows.
         LOG.info("%016x: New switch", dp.id)
+        status = self.switches.get(dp.id)
+        if status is None:
+            status = self.switches[dp.id] = SwitchStatus()
+        status.set_datapath(dp)
+        dp._slicer_status = status
 
         ## Delete all meters.
         mymsg = parser.OFPMeterMod(datapath=dp,
@@ -1303,23 +1653,26 @@ class TupleSlicer(app_manager.RyuApp):
                                    meter_id=ofp.OFPM_ALL)
         dp.send_msg(mymsg)
 
-        ## Delete all flows in T0, T1, T2.
+        ## The remaining set-up is sent with the rules for all slices
+        ## as one batch.
+
+        ## Delete all flows in T0, T1, T2, with one message covering
+        ## all tables.
         match = parser.OFPMatch()
-        for tbl in (0, 1, 2):
-            mymsg = parser.OFPFlowMod(command=ofp.OFPFC_DELETE,
-                                      datapath=dp,
-                                      table_id=tbl,
-                                      buffer_id=ofp.OFPCML_NO_BUFFER,
-                                      out_port=ofp.OFPP_ANY,
-                                      out_group=ofp.OFPG_ANY,
-                                      match=match)
-            dp.send_msg(mymsg)
+        mymsg = parser.OFPFlowMod(command=ofp.OFPFC_DELETE,
+                                  datapath=dp,
+                                  table_id=ofp.OFPTT_ALL,
+                                  buffer_id=ofp.OFPCML_NO_BUFFER,
+                                  out_port=ofp.OFPP_ANY,
+                                  out_group=ofp.OFPG_ANY,
+                                  match=match)
+        status.pending.append(mymsg)
 
         ## Delete all groups.
         mymsg = parser.OFPGroupMod(datapath=dp,
                                    command=ofp.OFPGC_DELETE,
                                    group_id=ofp.OFPG_ALL)
-        dp.send_msg(mymsg)
+        status.pending.append(mymsg)
 
         ## Drop LLDP packets.
         match = parser.OFPMatch(vlan_vid=0x0000,
@@ -1331,13 +1684,9 @@ class TupleSlicer(app_manager.RyuApp):
                                   priority=6,
                                   match=match,
                                   instructions=inst)
-        dp.send_msg(mymsg)
+        status.pending.append(mymsg)
 
         ## Mark all slices as invalid, then revalidate them.
-        if dp.id not in self.switches:
-            self.switches[dp.id] = SwitchStatus()
-        status = self.switches[dp.id]
-        status.set_datapath(dp)
         for p in ev.ports:
             status.port_added(p.port_no)
         status.invalidate()
@@ -1374,12 +1723,17 @@ class TupleSlicer(app_manager.RyuApp):
     def _not_heard_from(self, dp, group, mac):
         ofp = dp.ofproto
         parser = dp.ofproto_parser
-        status = self.switches[dp.id]
+        status = self.get_status(dp)
+        if status is None:
+            return
         tup = status.get_tuple_for_group(group)
         if tup is None:
             return
+        ## The tuple might have been removed from its slice, with its
+        ## group yet to be released by revalidation.
         slize = status.get_slice(tup)
-        tups = slize.get_tuples()
+        if slize is None:
+            return
         # group = status.get_group_for_tuple(tup)
 
         LOG.info("%016x: %s/G%03d/%17s not heard from",
@@ -1391,7 +1745,7 @@ class TupleSlicer(app_manager.RyuApp):
         match = parser.OFPMatch(eth_dst=mac)
         msg = parser.OFPFlowMod(command=ofp.OFPFC_DELETE,
                                 cookie=group,
-                                cookie_mask=0xffffffffffffffff,
+                                cookie_mask=_COOKIE_MASK,
                                 datapath=dp,
                                 table_id=2,
                                 match=match,
@@ -1401,12 +1755,40 @@ class TupleSlicer(app_manager.RyuApp):
         dp.send_msg(msg)
         return
 
-    def _learn(self, dp, tup, mac, timeout=600):
+    ## Learn the addresses deferred during a revalidation, once it
+    ## has finished.
+    def _learn_deferred(self, dp):
+        status = self.get_status(dp)
+        if status is None:
+            return
+        with status.revalidation:
+            pass
+        if status.datapath is not dp:
+            return
+        deferred = status.deferred_learns
+        status.deferred_learns = { }
+        for (tup, mac), timeout in deferred.items():
+            self._learn(dp, tup, mac, timeout=timeout)
+
+    ## Learn that an address has been seen on a tuple.  Set barrier
+    ## if anything sent next relies on the new rules being in place.
+    def _learn(self, dp, tup, mac, timeout=600, barrier=False):
         if dp is None:
             return
         LOG.info("%016x: %17s new on %s",
                  dp.id, mac, tuple_text(tup))
-        status = self.switches[dp.id]
+        status = self.get_status(dp)
+        if status is None:
+            return
+
+        ## Don't hold up other events waiting for a revalidation in
+        ## progress.  Learn in another thread once it has finished,
+        ## along with any other addresses seen meanwhile.
+        if status.revalidation.locked():
+            if not status.deferred_learns:
+                hub.spawn(self._learn_deferred, dp)
+            status.deferred_learns[(tup, mac)] = timeout
+            return
         status.revalidate()
 
         ## Is this tuple allocated to a slice?
@@ -1436,10 +1818,12 @@ class TupleSlicer(app_manager.RyuApp):
             sgroup = status.get_group_for_tuple(stup)
             match = parser.OFPMatch(metadata=sgroup, eth_dst=mac)
             ## Drop if this packet would be forwarded to its input.
-            actions = [] if group == sgroup \
-                      else status.tuple_action(tup, stup[0])
+            if group == sgroup:
+                actions = []
+            else:
+                actions = status.tuple_action(tup, stup[0])
             inst = [parser.OFPInstructionActions(ofp.OFPIT_APPLY_ACTIONS,
-                                                     actions)]
+                                                 actions)]
             ## Apply an egress meter for the destination that this
             ## packet has come from.
             if outmtr is not None:
@@ -1451,29 +1835,29 @@ class TupleSlicer(app_manager.RyuApp):
                                       priority=2,
                                       match=match,
                                       instructions=inst)
-            dp.send_msg(mymsg)
+            status.pending.append(mymsg)
 
         ## Make sure that, by deleting any existing MAC-specific rule,
         ## if the source address is seen again on a different port in
         ## the slice, the controller will deal with it.  Use the
         ## tuple's group to ensure we only delete rules for this
-        ## slice.
+        ## slice.  The match is the same for every tuple.
+        match = PreparedMatch(eth_src=mac)
         for stup in tups:
             if stup == tup:
                 continue
             sgroup = status.get_group_for_tuple(stup)
-            (_, tbl, _) = status.tuple_match(stup, mac)
-            match = parser.OFPMatch(eth_src=mac)
+            tbl = tuple_table(stup)
             mymsg = parser.OFPFlowMod(command=ofp.OFPFC_DELETE,
                                       cookie=sgroup,
-                                      cookie_mask=0xffffffffffffffff,
+                                      cookie_mask=_COOKIE_MASK,
                                       datapath=dp,
                                       table_id=tbl,
                                       buffer_id=ofp.OFPCML_NO_BUFFER,
                                       out_port=ofp.OFPP_ANY,
                                       out_group=ofp.OFPG_ANY,
                                       match=match)
-            dp.send_msg(mymsg)
+            status.pending.append(mymsg)
 
         ## In the source table, prevent traffic from this source
         ## address on this port from being forwarded to the controller
@@ -1503,8 +1887,10 @@ class TupleSlicer(app_manager.RyuApp):
                                   flags=ofp.OFPFF_SEND_FLOW_REM,
                                   match=match,
                                   instructions=inst)
-        dp.send_msg(mymsg)
+        status.pending.append(mymsg)
 
+        ## Send all the rules for this address together.
+        status.flush(barrier=barrier)
         return slize
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
@@ -1514,14 +1900,23 @@ class TupleSlicer(app_manager.RyuApp):
         dp = msg.datapath
         ofp = dp.ofproto
         parser = dp.ofproto_parser
-        status = self.switches[dp.id]
+        status = self.get_status(dp)
+        if status is None:
+            return
 
         ## We are only called if a packet has an unrecognized source
-        ## address.  Extract the fields we're interested in.
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocol(ethernet.ethernet)
-        mac = eth.src
-        dmac = eth.dst
+        ## address.  Extract the fields we're interested in.  Only the
+        ## Ethernet addresses are needed, so read them straight from
+        ## the frame if we have enough of it.
+        data = msg.data
+        if data is not None and len(data) >= 12:
+            dmac = mac_text(data[0:6])
+            mac = mac_text(data[6:12])
+        else:
+            pkt = packet.Packet(data)
+            eth = pkt.get_protocol(ethernet.ethernet)
+            mac = eth.src
+            dmac = eth.dst
         in_port = msg.match['in_port']
 
         ## The metadata identifies the tuple.
@@ -1531,8 +1926,15 @@ class TupleSlicer(app_manager.RyuApp):
             return
 
         ## Learn that this MAC address has most recently been seen on
-        ## this port.
-        slize = self._learn(dp, tup, mac)
+        ## this port.  Only if we are going to send the packet on
+        ## ourselves must the new rules be in place first.
+        slize = self._learn(dp, tup, mac,
+                            barrier=status.unknown_src_to_ctrl)
+
+        ## Without a slice, or if learning has been deferred, drop the
+        ## packet.
+        if slize is None:
+            return
 
         ## If we're only expecting a packet header, we assume the
         ## rules will send a complete packet to the destination table,
@@ -1540,9 +1942,9 @@ class TupleSlicer(app_manager.RyuApp):
         if not status.unknown_src_to_ctrl:
             return
 
-        ## Commit our changes before we submit the packet back through
-        ## the tables.
-        #dp.send_msg(parser.OFPBarrierRequest(dp))
+        ## Our changes have already been sent as one batch, ending
+        ## with a barrier or a bundle commit, so the switch applies
+        ## them before it handles the packet.
 
         ## Where is this packet going?
         dtup = slize.lookup(dmac)
@@ -1560,12 +1962,13 @@ class TupleSlicer(app_manager.RyuApp):
             return
         else:
             ## Perform the defined actions for the destination tuple.
+            ## Packet-out only reads them, so the shared list will do.
             actions = status.tuple_action(dtup, in_port)
             # ## Apply an egress meter.
             # if hasattr(parser, 'OFPActionMeter'):
             #     outmtr = status.get_outmeter(dtup)
             #     if outmtr is not None:
-            #         actions.insert(0, parser.OFPActionMeter(outmtr))
+            #         actions = [parser.OFPActionMeter(outmtr)] + actions
 
         ## Issue the packet.
         mymsg = parser.OFPPacketOut(datapath=dp,
@@ -1583,10 +1986,10 @@ class SliceController(ControllerBase):
            requirements={ 'dpid': dpid_lib.DPID_PATTERN })
     def get_config(self, req, **kwargs):
         dpid = dpid_lib.str_to_dpid(kwargs['dpid'])
-        if dpid not in self.ctrl.switches:
+        status = self.ctrl.switches.get(dpid)
+        if status is None:
             return Response(status=404)
 
-        status = self.ctrl.switches[dpid]
         body = json.dumps(status.get_config()) + "\n"
         return Response(content_type='application/json', body=body)
 
@@ -1600,34 +2003,39 @@ class SliceController(ControllerBase):
         except ValueError:
             return Response(status=400)
 
-        if dpid not in self.ctrl.switches:
-            self.ctrl.switches[dpid] = SwitchStatus()
-        status = self.ctrl.switches[dpid]
-        if 'disused' in new_config:
-            for tup in new_config['disused']:
-                status.discard_tuple(tup)
-        if 'slices' in new_config:
-            for lps in new_config['slices']:
-                ps = set()
-                inrates = {}
-                outrates = {}
-                for mp in lps:
-                    tup = tuple(mp['circuit'])
-                    ps.add(tup)
-                    if 'ingress-bw' in mp:
-                        inrates[tup] = mp['ingress-bw']
-                    if 'egress-bw' in mp:
-                        outrates[tup] = mp['egress-bw']
-                LOG.info("%016x: creating %s", dpid, tuples_text(ps))
-                status.create_slice(ps, inrates, outrates)
-        if 'dhcp' in new_config:
-            dp = api.get_datapath(self.ctrl, dpid)
-            if new_config['dhcp']:
-                self.ctrl.pass_dhcp(dp)
-            else:
-                self.ctrl.drop_dhcp(dp)
-        status.revalidate()
-        LOG.info("%016x: completed changes", dpid)
+        status = self.ctrl.switches.get(dpid)
+        if status is None:
+            status = self.ctrl.switches[dpid] = SwitchStatus()
+        with status.batch():
+            ## Switch to or from ONF bundles before anything is sent
+            ## for this request.
+            if 'bundles' in new_config:
+                status.use_bundles = bool(new_config['bundles'])
+            if 'disused' in new_config:
+                for tup in coerce_tuples(new_config['disused']):
+                    status.discard_tuple(tup)
+            if 'slices' in new_config:
+                for lps in new_config['slices']:
+                    ps = set()
+                    inrates = {}
+                    outrates = {}
+                    for mp in lps:
+                        tup = tuple(mp['circuit'])
+                        ps.add(tup)
+                        if 'ingress-bw' in mp:
+                            inrates[tup] = mp['ingress-bw']
+                        if 'egress-bw' in mp:
+                            outrates[tup] = mp['egress-bw']
+                    if LOG.isEnabledFor(logging.INFO):
+                        LOG.info("%016x: creating %s", dpid, tuples_text(ps))
+                    status.create_slice(ps, inrates, outrates)
+            if 'dhcp' in new_config:
+                dp = api.get_datapath(self.ctrl, dpid)
+                if new_config['dhcp']:
+                    self.ctrl.pass_dhcp(dp)
+                else:
+                    self.ctrl.drop_dhcp(dp)
+        LOG.info("%016x: queued changes", dpid)
         if 'learn' in new_config:
             dp = api.get_datapath(self.ctrl, dpid)
             mac = new_config['learn']['mac']